@@ -1,4 +1,16 @@
+import os
+
 from setuptools import setup
 
+
+def ext_modules():
+    """Compile the entity transformations with mypyc when UPDATE_MAUD_MYPYC is set."""
+    if not os.environ.get("UPDATE_MAUD_MYPYC"):
+        return []
+    from mypyc.build import mypycify
+
+    return mypycify(["--ignore-missing-imports", "update_maud/transform.py"])
+
+
 if __name__ == "__main__":
-    setup()
+    setup(ext_modules=ext_modules())
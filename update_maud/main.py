@@ -1,15 +1,27 @@
 """Script to transform Maud model to the current version."""
 import os
 import shutil
+from dataclasses import fields
 from pathlib import Path
 
 import click
 import pandas as pd
-import toml
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import rtoml
 from maud.data_model.maud_config import ODEConfig
 
 from .update_model_toml import update_model_toml
-from .update_priors import update_inits, update_priors
+from .update_priors import (
+    read_priors,
+    remove_underscores,
+    update_inits,
+    update_priors,
+    write_priors,
+)
+
+
+ODE_CONFIG_FIELDS = frozenset(field.name for field in fields(ODEConfig))
 
 
 def rename_keys(dict_: dict, key_map: dict) -> dict:
@@ -22,7 +34,7 @@ def rename_keys(dict_: dict, key_map: dict) -> dict:
 
 def update_config(old_config: Path, new_config: Path):
     with open(old_config) as f:
-        config = toml.load(f)
+        config = rtoml.load(f, none_value=None)
     config = rename_keys(
         config,
         {
@@ -39,26 +51,25 @@ def update_config(old_config: Path, new_config: Path):
             "abs_tol_forward": "abs_tol",
         },
     )
-    allowed = ODEConfig.__dict__.keys()
     config["ode_config"] = {
-        k: v for k, v in config["ode_config"].items() if k in allowed
+        k: v for k, v in config["ode_config"].items() if k in ODE_CONFIG_FIELDS
     }
     with open(new_config, "w") as f:
-        toml.dump(config, f)
+        rtoml.dump(config, f, none_value=None)
 
 
 def update_measurements(old_measurements: Path, new_measurements: Path):
-    df = pd.read_csv(old_measurements)
-    df.experiment_id = df.experiment_id.str.replace("_", "")
-    df.loc[df.measurement_type == "flux", "target_id"] = df.loc[
-        df.measurement_type == "flux", "target_id"
-    ].str.replace("_", "")
+    df = pd.read_csv(old_measurements, engine="pyarrow")
+    df.experiment_id = remove_underscores(df.experiment_id)
+    df.loc[df.measurement_type == "flux", "target_id"] = remove_underscores(
+        df.loc[df.measurement_type == "flux", "target_id"]
+    )
     df.to_csv(new_measurements, index=False)
 
 
 def update_biological_config(old_toml: Path, new_toml: Path):
     with open(old_toml) as f:
-        config = toml.load(f)
+        config = rtoml.load(f, none_value=None)
     for exp in config["experiment"]:
         exp.update({"id": exp["id"].replace("_", "")})
     config["experiment"] = [
@@ -66,20 +77,23 @@ def update_biological_config(old_toml: Path, new_toml: Path):
         for exp in config["experiment"]
     ]
     with open(new_toml, "w") as f:
-        toml.dump(config, f)
+        rtoml.dump(config, f, none_value=None)
 
 
 def update_dgf(config, data_path: Path, out_path: Path):
     """Remove all underscores in identifiers in dgf files."""
     mean_path = config["dgf_mean_file"]
     cov_path = config["dgf_covariance_file"]
-    means = pd.read_csv(data_path / mean_path)
-    cov = pd.read_csv(data_path / cov_path)
-    means.metabolite = means.metabolite.str.replace("_", "")
-    cov.metabolite = cov.metabolite.str.replace("_", "")
-    cov.columns = cov.columns.str.replace("_", "")
+    means = pd.read_csv(data_path / mean_path, engine="pyarrow")
+    # the covariance matrix is metabolites x metabolites wide
+    cov = pd.read_csv(data_path / cov_path, engine="pyarrow")
+    means.metabolite = means.metabolite.str.replace("_", "", regex=False)
+    cov.metabolite = cov.metabolite.str.replace("_", "", regex=False)
+    cov.columns = [col.replace("_", "") for col in cov.columns.tolist()]
     means.to_csv(out_path / mean_path, index=False)
-    cov.to_csv(out_path / cov_path, index=False)
+    pacsv.write_csv(
+        pa.Table.from_pandas(cov, preserve_index=False), out_path / cov_path
+    )
 
 
 @click.command()
@@ -92,7 +106,7 @@ def cli_entry(data_dir: click.Path, outdir: click.Path):
     data_path = Path(data_dir)
     out_path = Path(outdir)
     with open(data_path / "config.toml") as f:
-        config = toml.load(f)
+        config = rtoml.load(f, none_value=None)
     old_toml = data_path / config["kinetic_model"]
     new_toml = out_path / config["kinetic_model"]
     old_priors = data_path / config["priors"]
@@ -102,7 +116,7 @@ def cli_entry(data_dir: click.Path, outdir: click.Path):
     measurements_file = config["measurements"]
     bio_config_file = config["biological_config"]
     model = update_model_toml(old_toml, new_toml)
-    update_priors(pd.read_csv(old_priors), model).to_csv(new_priors, index=False)
+    write_priors(update_priors(read_priors(old_priors), model), new_priors)
     update_measurements(data_path / measurements_file, out_path / measurements_file)
     update_biological_config(data_path / bio_config_file, out_path / bio_config_file)
     update_config(data_path / "config.toml", out_path / "config.toml")
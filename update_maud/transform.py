@@ -0,0 +1,83 @@
+"""Per-entity transformations from the old to the new maud representation."""
+import re
+from typing import TYPE_CHECKING, Any, Iterator
+
+import maud.data_model.kinetic_model as md
+
+
+if TYPE_CHECKING:
+    from .update_model_toml import ReactionPrev
+
+
+UNDER_PAT = re.compile(r"_(?![a-z]$)")
+REVERSIBLE_MECHANISMS = frozenset(
+    ["reversible_modular_rate_law", "reversible_michaelis_menten"]
+)
+
+
+def strip_id(id_: str, cache: dict[str, str]) -> str:
+    """Remove all the underscores of an identifier, memoized in `cache`."""
+    stripped = cache.get(id_)
+    if stripped is None:
+        stripped = cache[id_] = id_.replace("_", "")
+    return stripped
+
+
+def strip_mic_id(mic_id: str, cache: dict[str, str]) -> str:
+    """Remove the underscores of a mic identifier but the compartment one."""
+    stripped = cache.get(mic_id)
+    if stripped is None:
+        stripped = cache[mic_id] = UNDER_PAT.sub("", mic_id)
+    return stripped
+
+
+def iter_reaction_entities(
+    reac: "ReactionPrev", ids: dict[str, str], mic_ids: dict[str, str]
+) -> Iterator[tuple[str, Any]]:
+    """Yield the new entities of an old reaction as (ModelNew field, entity).
+
+    `ids` and `mic_ids` memoize the stripped identifiers across the reactions
+    of a model, see `strip_id` and `strip_mic_id`.
+    """
+    # bind globals to locals, they are looked up for every entity
+    REV = md.ReactionMechanism.REVERSIBLE_MICHAELIS_MENTEN
+    IRR = md.ReactionMechanism.IRREVERSIBLE_MICHAELIS_MENTEN
+    INH = md.ModificationType.INHIBITION
+    ACT = md.ModificationType.ACTIVATION
+    mechanism = REV if reac.mechanism in REVERSIBLE_MECHANISMS else IRR
+    reac_id: str = strip_id(reac.id, ids)
+    yield "reaction", md.Reaction(
+        id=reac_id,
+        name=reac.name,
+        mechanism=mechanism,
+        stoichiometry={
+            strip_mic_id(k, mic_ids): v for k, v in reac.stoichiometry.items()
+        },
+        water_stoichiometry=reac.water_stoichiometry,
+        transported_charge=reac.transported_charge,
+    )
+    for enz in reac.enzyme:
+        enz_id: str = strip_id(enz.id, ids)
+        yield "enzyme", md.Enzyme(id=enz_id, name=enz.name, subunits=enz.subunits)
+        yield "enzyme_reaction", md.EnzymeReaction(
+            enzyme_id=enz_id, reaction_id=reac_id
+        )
+        if enz.modifier is None:
+            continue
+        for modifier in enz.modifier:
+            if modifier.modifier_type == "competitive_inhibitor":
+                yield "competitive_inhibition", md.CompetitiveInhibition(
+                    enzyme_id=enz_id,
+                    reaction_id=reac_id,
+                    metabolite_id=strip_id(modifier.mic_id[:-2], ids),
+                    compartment_id="c",
+                )
+            else:
+                yield "allostery", md.Allostery(
+                    enzyme_id=enz_id,
+                    metabolite_id=strip_id(modifier.mic_id[:-2], ids),
+                    compartment_id="c",
+                    modification_type=(
+                        INH if modifier.modifier_type == "allosteric_inhibitor" else ACT
+                    ),
+                )
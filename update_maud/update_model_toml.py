@@ -1,15 +1,14 @@
 """Script to transform Maud model to the current version."""
-import json
-import re
+from dataclasses import dataclass, fields, is_dataclass
+from enum import Enum
+from pathlib import Path
 from typing import Optional
 
-import click
 import maud.data_model.kinetic_model as md
-import toml
+import rtoml
 from pydantic import BaseModel, Field
 
-
-UNDER_PAT = re.compile(r"_(?![a-z]$)")
+from .transform import iter_reaction_entities, strip_id
 
 
 class Compartment(BaseModel):
@@ -18,50 +17,126 @@ class Compartment(BaseModel):
     volume: float
 
 
-class MetabolitePrev(BaseModel):
-    id: str = Field(alias="metabolite")
+@dataclass(slots=True)
+class MetabolitePrev:
+    id: str
     compartment: str
     balanced: bool
     name: Optional[str] = None
     metabolite_inchi_key: Optional[str] = None
 
+    @classmethod
+    def from_dict(cls, met: dict) -> "MetabolitePrev":
+        """Build from an old toml table."""
+        return cls(
+            id=met["metabolite"],
+            compartment=met["compartment"],
+            balanced=met["balanced"],
+            name=met.get("name"),
+            metabolite_inchi_key=met.get("metabolite_inchi_key"),
+        )
 
-class ModifierPrev(BaseModel):
+
+@dataclass(slots=True)
+class ModifierPrev:
     modifier_type: str
     mic_id: str
 
+    @classmethod
+    def from_dict(cls, modifier: dict) -> "ModifierPrev":
+        """Build from an old toml table."""
+        return cls(modifier_type=modifier["modifier_type"], mic_id=modifier["mic_id"])
+
 
-class EnzymePrev(BaseModel):
+@dataclass(slots=True)
+class EnzymePrev:
     id: str
     name: str
     subunits: int = 1
-    modifier: Optional[list[ModifierPrev]]
+    modifier: Optional[list[ModifierPrev]] = None
+
+    @classmethod
+    def from_dict(cls, enz: dict) -> "EnzymePrev":
+        """Build from an old toml table."""
+        return cls(
+            id=enz["id"],
+            name=enz["name"],
+            subunits=enz.get("subunits", 1),
+            modifier=(
+                [ModifierPrev.from_dict(mod) for mod in enz["modifier"]]
+                if "modifier" in enz
+                else None
+            ),
+        )
 
 
-class ReactionPrev(BaseModel):
+@dataclass(slots=True)
+class ReactionPrev:
     id: str
     name: str
-    mechanism: Optional[str] = "reversible_modular_rate_law"
     stoichiometry: dict[str, float]
     enzyme: list[EnzymePrev]
+    mechanism: str = "reversible_modular_rate_law"
     water_stoichiometry: float = 0
     transported_charge: float = 0
 
+    @classmethod
+    def from_dict(cls, reac: dict) -> "ReactionPrev":
+        """Build from an old toml table."""
+        return cls(
+            id=reac["id"],
+            name=reac["name"],
+            stoichiometry=reac["stoichiometry"],
+            enzyme=[EnzymePrev.from_dict(enz) for enz in reac["enzyme"]],
+            mechanism=reac.get("mechanism", "reversible_modular_rate_law"),
+            water_stoichiometry=reac.get("water_stoichiometry", 0),
+            transported_charge=reac.get("transported_charge", 0),
+        )
+
 
-class DrainPrev(BaseModel):
+@dataclass(slots=True)
+class DrainPrev:
     id: str
     name: str
     stoichiometry: dict[str, float]
 
+    @classmethod
+    def from_dict(cls, drain: dict) -> "DrainPrev":
+        """Build from an old toml table."""
+        return cls(
+            id=drain["id"], name=drain["name"], stoichiometry=drain["stoichiometry"]
+        )
+
 
-class ModelPrev(BaseModel):
+@dataclass(slots=True)
+class ModelPrev:
     compartment: list[Compartment]
     reaction: list[ReactionPrev]
-    metabolite: list[MetabolitePrev] = Field(alias="metabolite-in-compartment")
+    metabolite: list[MetabolitePrev]
     drain: Optional[list[DrainPrev]] = None
 
-    class Config:
-        allow_population_by_field_name = True
+    @classmethod
+    def from_dict(cls, model: dict) -> "ModelPrev":
+        """Walk a parsed old toml file once.
+
+        The input is trusted to follow the old schema, so only the compartments,
+        which end up in the new model, are validated.
+        """
+        mics = (
+            model["metabolite-in-compartment"]
+            if "metabolite-in-compartment" in model
+            else model["metabolite"]
+        )
+        return cls(
+            compartment=[Compartment.parse_obj(comp) for comp in model["compartment"]],
+            reaction=[ReactionPrev.from_dict(reac) for reac in model["reaction"]],
+            metabolite=[MetabolitePrev.from_dict(met) for met in mics],
+            drain=(
+                [DrainPrev.from_dict(drain) for drain in model["drain"]]
+                if "drain" in model
+                else None
+            ),
+        )
 
 
 class ModelNew(BaseModel):
@@ -79,134 +154,110 @@ class ModelNew(BaseModel):
 
 def update_model(old_model: ModelPrev) -> ModelNew:
     """Translate a Maud old model to a new model."""
-    reactions = []
-    enzymes = []
-    enzyme_reactions = []
-    allosteries = []
-    comp_inhibitions = []
+    entities: dict[str, list] = {
+        "reaction": [],
+        "enzyme": [],
+        "enzyme_reaction": [],
+        "allostery": [],
+        "competitive_inhibition": [],
+    }
+    # stripped identifiers, only kept for the length of the update
+    ids: dict[str, str] = {}
+    mic_ids: dict[str, str] = {}
     for reac in old_model.reaction:
-        mechanism = (
-            md.ReactionMechanism.REVERSIBLE_MICHAELIS_MENTEN
-            if reac.mechanism.startswith("reversible")
-            else md.ReactionMechanism.IRREVERSIBLE_MICHAELIS_MENTEN
-        )
-        reac_id = reac.id.replace("_", "")
-        reactions.append(
-            md.Reaction(
-                id=reac_id,
-                name=reac.name,
-                mechanism=mechanism,
-                stoichiometry={
-                    UNDER_PAT.sub("", k): v for k, v in reac.stoichiometry.items()
-                },
-                water_stoichiometry=reac.water_stoichiometry,
-                transported_charge=reac.transported_charge,
-            )
-        )
-        for enz in reac.enzyme:
-            enz_id = enz.id.replace("_", "")
-            enzymes.append(md.Enzyme(id=enz_id, name=enz.name, subunits=enz.subunits))
-            enzyme_reactions.append(
-                md.EnzymeReaction(enzyme_id=enz_id, reaction_id=reac_id)
-            )
-            if enz.modifier is not None:
-                for modifier in enz.modifier:
-                    if modifier.modifier_type == "competitive_inhibitor":
-                        comp_inhibitions.append(
-                            md.CompetitiveInhibition(
-                                enzyme_id=enz_id,
-                                reaction_id=reac_id,
-                                metabolite_id=modifier.mic_id[:-2].replace("_", ""),
-                                compartment_id="c",
-                            )
-                        )
-                    else:
-                        mod_type = (
-                            md.ModificationType.INHIBITION
-                            if modifier.modifier_type == "allosteric_inhibitor"
-                            else md.ModificationType.ACTIVATION
-                        )
-                        allosteries.append(
-                            md.Allostery(
-                                enzyme_id=enz_id,
-                                metabolite_id=modifier.mic_id[:-2].replace("_", ""),
-                                compartment_id="c",
-                                modification_type=mod_type,
-                            )
-                        )
-    metabolites = []
-    comp_metabolites = []
+        for kind, entity in iter_reaction_entities(reac, ids, mic_ids):
+            entities[kind].append(entity)
+    # the first metabolite-in-compartment of each metabolite names it
+    unique_mets: dict[str, MetabolitePrev] = {}
     for met in old_model.metabolite:
-        met_id = met.id.replace("_", "")
-        if not any(met_id == met.id for met in metabolites):
-            metabolites.append(
-                md.Metabolite(
-                    id=met_id, name=met.name, inchi_key=met.metabolite_inchi_key
-                )
-            )
-        comp_metabolites.append(
-            md.MetaboliteInCompartment(
-                metabolite_id=met_id,
-                compartment_id=met.compartment,
-                balanced=met.balanced,
-            )
+        unique_mets.setdefault(strip_id(met.id, ids), met)
+    metabolites = [
+        md.Metabolite(id=met_id, name=met.name, inchi_key=met.metabolite_inchi_key)
+        for met_id, met in unique_mets.items()
+    ]
+    comp_metabolites = [
+        md.MetaboliteInCompartment(
+            metabolite_id=strip_id(met.id, ids),
+            compartment_id=met.compartment,
+            balanced=met.balanced,
         )
+        for met in old_model.metabolite
+    ]
     # TODO(jorge): not sure how phosphorylation looks lik
-    return ModelNew(
+    # the entities were already validated on instantiation, skip re-validation
+    return ModelNew.construct(
         compartment=old_model.compartment,
-        enzyme=enzymes,
-        reaction=reactions,
-        enzyme_reaction=enzyme_reactions,
         metabolite=metabolites,
         metabolite_in_compartment=comp_metabolites,
-        allostery=allosteries,
-        competitive_inhibition=comp_inhibitions,
+        reaction=entities["reaction"],
+        enzyme=entities["enzyme"],
+        enzyme_reaction=entities["enzyme_reaction"],
+        allostery=entities["allostery"],
+        competitive_inhibition=entities["competitive_inhibition"],
     )
 
 
-def exclude_id(model: BaseModel, keys: list[str]):
-    for key in keys:
-        for i in range(len(model[key])):
-            del model[key][i]["id"]
-
+# maud derives the ids of these entities from the rest of their fields
+DERIVED_ID_ENTITIES = frozenset(
+    [
+        "enzyme_reaction",
+        "metabolite_in_compartment",
+        "allostery",
+        "competitive_inhibition",
+    ]
+)
 
-def reaction_mech_to_name(model: dict):
-    for reac in model["reaction"]:
-        reac["mechanism"] = md.ReactionMechanism(reac["mechanism"]).name
-    for allostery in model["allostery"]:
-        allostery["modification_type"] = md.ModificationType(
-            allostery["modification_type"]
-        ).name
 
+def to_builtin(obj):
+    """Recursively convert models, dataclasses and enums into plain python objects.
 
-def write_new_model(model: ModelNew, out_file: str):
-    """Serialize a model into toml.
-
-    The intermediate JSON step is required so that dataclasses are
-    serialized properly.
+    The maud entities are pydantic dataclasses, which `BaseModel.dict` leaves
+    untouched. Enums (reaction mechanisms and modification types) are written
+    by name, which is what maud expects in the toml file.
+    """
+    if isinstance(obj, BaseModel):
+        return to_builtin(obj.dict())
+    if is_dataclass(obj):
+        return {
+            field.name: to_builtin(getattr(obj, field.name)) for field in fields(obj)
+        }
+    if isinstance(obj, dict):
+        return {key: to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [to_builtin(value) for value in obj]
+    if isinstance(obj, Enum):
+        return obj.name
+    return obj
+
+
+def write_new_model(model: ModelNew, out_file: Path):
+    """Serialize a model into toml, one entity at a time.
+
+    Only the entity being written is converted to plain python objects, so
+    the model is never held twice in memory. Empty sections are written first
+    since they are plain keys, which would otherwise belong to the last table.
     """
+    sections = [(name, getattr(model, name)) for name in model.__fields__]
     with open(out_file, "w") as f:
-        model_dict = json.loads(model.json())
-        exclude_id(
-            model_dict,
-            [
-                "enzyme_reaction",
-                "metabolite_in_compartment",
-                "allostery",
-                "competitive_inhibition",
-            ],
-        )
-        reaction_mech_to_name(model_dict)
-        toml.dump(model_dict, f)
-
-
-def read_old_maud(toml_file: str):
+        for name, entities in sections:
+            if not entities:
+                rtoml.dump({name: []}, f)
+        for name, entities in sections:
+            for entity in entities:
+                entity_dict = to_builtin(entity)
+                if name in DERIVED_ID_ENTITIES:
+                    del entity_dict["id"]
+                rtoml.dump({name: [entity_dict]}, f, none_value=None)
+                f.write("\n")
+
+
+def read_old_maud(toml_file: Path):
     with open(toml_file) as f:
-        data = ModelPrev.parse_obj(toml.load(f))
+        data = ModelPrev.from_dict(rtoml.load(f, none_value=None))
     return data
 
 
-def update_model_toml(old_toml: click.Path, output: click.Path):
+def update_model_toml(old_toml: Path, output: Path):
     data = read_old_maud(old_toml)
     new_data = update_model(data)
     write_new_model(new_data, output)
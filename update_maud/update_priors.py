@@ -1,13 +1,18 @@
 """Update priors file to newer maud impl."""
 
 import re
-from copy import deepcopy
+from operator import attrgetter
 
 import click
+import maud.data_model.kinetic_model as md
+import numpy as np
 import pandas as pd
-import toml
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import rtoml
 
-from .update_model_toml import UNDER_PAT, ModelNew
+from .update_model_toml import ModelNew
 
 
 NEW_PRIOR_COLS = [
@@ -22,93 +27,223 @@ NEW_PRIOR_COLS = [
     "pct1",
     "pct99",
 ]
+# the rest of the new prior columns are identifiers
+PRIOR_VALUE_COLS = ["location", "scale", "pct1", "pct99"]
+# identifiers are output as arrow strings, written without python objects
+ID_DTYPE = pd.ArrowDtype(pa.large_string())
+# old prior columns that end up in the new priors, by their new name
+PRIOR_COLUMNS = {
+    "parameter_type": "parameter",
+    "mic_id": "metabolite",
+    "enzyme_id": "enzyme",
+    # will fill out the other reactions later
+    "drain_id": "reaction",
+    "experiment_id": "experiment",
+    "location": "location",
+    "scale": "scale",
+    "pct1": "pct1",
+    "pct99": "pct99",
+}
+# identifiers are parsed as arrow strings, the rest of the columns are numeric
+PRIOR_DTYPES = {
+    "parameter_type": "string[pyarrow]",
+    "mic_id": "string[pyarrow]",
+    "enzyme_id": "string[pyarrow]",
+    "drain_id": "string[pyarrow]",
+    "experiment_id": "string[pyarrow]",
+    "location": "float64",
+    "scale": "float64",
+    "pct1": "float64",
+    "pct99": "float64",
+}
+PARAMETER_RENAMES = {"diss_t": "dissociation_constant", "conc_phos": "conc_pme"}
+# parameters now indexed by the reaction of their enzyme
+PRIOR_REACTION_PARAMETERS = ["kcat", "ki"]
+INIT_REACTION_PARAMETERS = ["kcat", "km", "ki"]
+# parameters that are dropped if their enzyme is not in the new model
+PRIOR_ENZYME_PARAMETERS = ["kcat", "conc_enzyme"]
+INIT_ENZYME_PARAMETERS = ["kcat", "conc_enzyme", "km"]
+# the enzymes of both kinds of parameters are looked up together
+PRIOR_LOOKUP_PARAMETERS = list(
+    dict.fromkeys(PRIOR_REACTION_PARAMETERS + PRIOR_ENZYME_PARAMETERS)
+)
+INIT_LOOKUP_PARAMETERS = list(
+    dict.fromkeys(INIT_REACTION_PARAMETERS + INIT_ENZYME_PARAMETERS)
+)
 # the comparment is represented by a single letter,
 # prefixed by underscored at the end of the entity.
-COMP_PAT = re.compile(r"(.*)_([a-z]$)")
+COMP_PAT = re.compile(r"(?P<metabolite>.*)_(?P<compartment>[a-z])$")
 
 
-def query_lookup(
-    query_id: str,
+def read_priors(priors_file) -> pd.DataFrame:
+    """Read an old priors csv with the pyarrow parser and without dtype inference."""
+    return pd.read_csv(priors_file, engine="pyarrow", dtype=PRIOR_DTYPES)
+
+
+def write_priors(priors_df: pd.DataFrame, priors_file):
+    """Write a priors table with the arrow csv writer."""
+    pacsv.write_csv(pa.Table.from_pandas(priors_df, preserve_index=False), priors_file)
+
+
+def remove_underscores(ids: pd.Series) -> pd.Series:
+    """Remove the underscores of a series of identifiers.
+
+    The replacement is done once per distinct identifier instead of once per row.
+    Identifiers that are not strings (e.g. numeric experiments) are kept as is.
+    """
+    codes, uniques = pd.factorize(ids)
+    stripped = np.array(
+        [uniq.replace("_", "") if isinstance(uniq, str) else uniq for uniq in uniques]
+        # missing values are coded as -1
+        + [np.nan],
+        dtype=object,
+    )
+    return pd.Series(stripped[codes], index=ids.index, name=ids.name)
+
+
+def split_compartment(mic_ids: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Split mic ids into their metabolite and compartment ids in a single pass.
+
+    The underscores of the metabolite ids are removed on the way. Both steps
+    run on arrow's RE2 kernels over the whole column.
+    """
+    # typed so that all-missing columns (parsed as floats) are accepted
+    mics = pa.array(mic_ids, from_pandas=True, type=pa.string())
+    # a missing mic id has a missing metabolite and compartment
+    mets, comps = pc.extract_regex(mics, COMP_PAT.pattern).flatten()
+    # ids without a compartment suffix are metabolites as a whole
+    mets = pc.coalesce(mets, mics)
+    return (
+        pd.Series(
+            pc.replace_substring(mets, "_", "").to_numpy(zero_copy_only=False),
+            index=mic_ids.index,
+        ),
+        pd.Series(comps.to_numpy(zero_copy_only=False), index=mic_ids.index),
+    )
+
+
+def lookup_table(
     model: ModelNew,
     query_ns: str = "enzyme_id",
     lookup: str = "enzyme_reaction",
     key: str = "reaction_id",
-):
-    """Lookup the corresponding reaction of an enzyme.
+) -> dict[str, str]:
+    """Build a {query: key} map to lookup the corresponding reaction of an enzyme.
 
     Trivial since there were not promiscuous enzymes before.
     """
-    enz_id = query_id.replace("_", "")
-    return next(
-        enz_reac.__getattribute__(key)
-        for enz_reac in model.__getattribute__(lookup)
-        if enz_reac.__getattribute__(query_ns) == enz_id
-    )
+    return dict(map(attrgetter(query_ns, key), getattr(model, lookup)))
 
 
-def is_valid_enzyme(enzyme_id: str, model: ModelNew):
-    if not isinstance(enzyme_id, str):
-        return False
-    enz_id = enzyme_id.replace("_", "")
-    return any(
-        enz_reac.reaction_id
-        for enz_reac in model.enzyme_reaction
-        if enz_reac.enzyme_id == enz_id
+def parameter_rows(groups: dict[str, np.ndarray], parameters: list[str]) -> np.ndarray:
+    """Get the positions of the rows of any of the `parameters`.
+
+    `groups` are the positions of each parameter, from `DataFrame.groupby.indices`.
+    """
+    return np.concatenate(
+        [groups.get(param, np.array([], dtype=np.intp)) for param in parameters]
     )
 
 
+def enzyme_reactions(
+    df: pd.DataFrame, rows: np.ndarray, enz2reac: dict[str, str]
+) -> np.ndarray:
+    """Look up the reactions of the enzymes at the positions `rows` at once.
+
+    The result spans the whole frame, it is missing outside of `rows` and for
+    enzymes that are not in the model.
+    """
+    reactions = np.full(len(df), np.nan, dtype=object)
+    reactions[rows] = df.enzyme.iloc[rows].map(enz2reac).to_numpy(dtype=object)
+    return reactions
+
+
+def fill_reactions(
+    df: pd.DataFrame, rows: np.ndarray, reactions: np.ndarray
+) -> np.ndarray:
+    """Fill in the looked up `reactions` of the enzymes at the positions `rows`.
+
+    The assignment is done on a copy of the underlying array of the reaction
+    column, bypassing the index alignment of pandas' setitem.
+    """
+    reaction = df.reaction.to_numpy(dtype=object, na_value=np.nan, copy=True)
+    reaction[rows] = reactions[rows]
+    return reaction
+
+
+def known_enzyme_rows(rows: np.ndarray, reactions: np.ndarray) -> np.ndarray:
+    """Mask the rows to keep after dropping enzymes that are not in the model.
+
+    Only the rows at the positions `rows` refer to an enzyme, the rest are kept.
+    """
+    keep = np.ones(len(reactions), dtype=bool)
+    keep[rows] = pd.notna(reactions[rows])
+    return keep
+
+
+def check_reactions(
+    df: pd.DataFrame, rows: np.ndarray, reactions: np.ndarray, keep: np.ndarray
+):
+    """Raise if a kept row at the positions `rows` did not get a reaction.
+
+    Only some parameters are dropped along with enzymes that are not in the
+    model, the rest of them would be written without their reaction.
+    """
+    missing = rows[keep[rows] & pd.isna(reactions[rows])]
+    if len(missing):
+        enzymes = ", ".join(map(str, df.enzyme.iloc[missing].unique()))
+        raise ValueError(f"Enzymes without a reaction in the new model: {enzymes}")
+
+
 def update_priors(priors_df: pd.DataFrame, model: ModelNew) -> pd.DataFrame:
-    df = priors_df.copy()
-    target_cols = deepcopy(NEW_PRIOR_COLS)
-    df.rename(
-        {
-            "parameter_type": "parameter",
-            "enzyme_id": "enzyme",
-            "experiment_id": "experiment",
-            "mic_id": "metabolite",
-            # will fill out the other reactions later
-            "drain_id": "reaction",
-        },
-        axis=1,
-        inplace=True,
-    )
-    df["compartment"] = None
+    target_cols = NEW_PRIOR_COLS.copy()
+    enz2reac = lookup_table(model)
+    # only copy the columns that make it to the output, all of them are
+    # required except for the drains, which files without drains may lack
+    old_cols = [col for col in PRIOR_COLUMNS if col != "drain_id"]
+    df = priors_df[old_cols].rename(columns=PRIOR_COLUMNS)
+    df["reaction"] = priors_df["drain_id"] if "drain_id" in priors_df else np.nan
     # compartment separation of metabolites
-    df.loc[~pd.isna(df.metabolite), "compartment"] = df.loc[
-        ~pd.isna(df.metabolite), "metabolite"
-    ].apply(lambda x: COMP_PAT.sub(r"\2", x))
-    df.loc[~pd.isna(df.metabolite), "metabolite"] = df.loc[
-        ~pd.isna(df.metabolite), "metabolite"
-    ].apply(lambda x: COMP_PAT.sub(r"\1", x))
+    df["metabolite"], df["compartment"] = split_compartment(df.metabolite)
     # underscores are forbidden
-    df.enzyme = df.enzyme.str.replace("_", "")
-    df.experiment = df.experiment.str.replace("_", "")
-    df.metabolite = df.metabolite.str.replace("_", "")
-    df.parameter = df.parameter.str.replace("diss_t", "dissociation_constant")
-    df.parameter = df.parameter.str.replace("conc_phos", "conc_pme")
-    # make sure that every enzyme is actually in the final config
-    df = df.loc[
-        ~df.parameter.isin(["kcat", "conc_enzyme"])
-        | df.enzyme.apply(lambda x: is_valid_enzyme(x, model)),
-        :,
-    ]
+    df.enzyme = remove_underscores(df.enzyme)
+    df.experiment = remove_underscores(df.experiment)
+    df.parameter = df.parameter.replace(PARAMETER_RENAMES)
+    # positions of the rows of each parameter, scanned only once
+    groups = df.groupby("parameter", sort=False).indices
+    # the enzymes of all the parameters that need one are looked up only once
+    reactions = enzyme_reactions(
+        df, parameter_rows(groups, PRIOR_LOOKUP_PARAMETERS), enz2reac
+    )
     # add reaction ids
-    df.loc[df.parameter.isin(["kcat", "ki"]), "reaction"] = df.loc[
-        df.parameter.isin(["kcat", "ki"]), "enzyme"
-    ].apply(lambda x: query_lookup(x, model))
-    if (df.parameter == "conc_phos").any():
+    reac_rows = parameter_rows(groups, PRIOR_REACTION_PARAMETERS)
+    df["reaction"] = fill_reactions(df, reac_rows, reactions)
+    # make sure that every enzyme is actually in the final config
+    keep = known_enzyme_rows(parameter_rows(groups, PRIOR_ENZYME_PARAMETERS), reactions)
+    check_reactions(df, reac_rows, reactions, keep)
+    df = df.iloc[keep]
+    if "conc_phos" in groups:
         target_cols.append("phosphorylation_modifying_enzyme")
         # TODO(jorge): I have to look up an example of this
         raise NotImplementedError("Phosphorylation update is not implemented")
-    # the previous steps are only succesful if this works
-    df = df[target_cols]
-    return df
+    # the previous steps are only succesful if this works, the output is
+    # assembled from the columns themselves instead of projecting the frame
+    return pd.DataFrame(
+        {
+            col: df[col] if col in PRIOR_VALUE_COLS else df[col].astype(ID_DTYPE)
+            for col in target_cols
+        },
+        copy=False,
+    )
 
 
 def update_inits(inits_df: pd.DataFrame, model: ModelNew) -> pd.DataFrame:
     """Update the generated inits to the new format."""
     df = inits_df.copy()
-    df.loc[~pd.isna(df.drain_id), "parameter_name"] = "drain"
+    enz2reac = lookup_table(model)
+    parameter = df.parameter_name.to_numpy(dtype=object, copy=True)
+    parameter[df.drain_id.notna().to_numpy()] = "drain"
+    df["parameter_name"] = parameter
     df.rename(
         {
             "parameter_name": "parameter",
@@ -120,29 +255,25 @@ def update_inits(inits_df: pd.DataFrame, model: ModelNew) -> pd.DataFrame:
         axis=1,
         inplace=True,
     )
-    df["compartment"] = None
     # compartment separation of metabolites
-    df.loc[~pd.isna(df.mic_id), "compartment"] = df.loc[
-        ~pd.isna(df.mic_id), "mic_id"
-    ].apply(lambda x: COMP_PAT.sub(r"\2", x))
-    df.loc[~pd.isna(df.mic_id), "mic_id"] = df.loc[~pd.isna(df.mic_id), "mic_id"].apply(
-        lambda x: COMP_PAT.sub(r"\1", x)
+    df["mic_id"], df["compartment"] = split_compartment(df.mic_id)
+    # enzymes are looked up in the new model, remove their underscores first
+    df.enzyme = remove_underscores(df.enzyme)
+    # positions of the rows of each parameter, scanned only once
+    groups = df.groupby("parameter", sort=False).indices
+    # the enzymes of all the parameters that need one are looked up only once
+    reactions = enzyme_reactions(
+        df, parameter_rows(groups, INIT_LOOKUP_PARAMETERS), enz2reac
     )
-    df = df.loc[
-        ~df.parameter.isin(["kcat", "conc_enzyme", "km"])
-        | df.enzyme.apply(lambda x: is_valid_enzyme(x, model)),
-        :,
-    ]
     # add reaction ids
-    df.loc[df.parameter.isin(["kcat", "km", "ki"]), "reaction"] = df.loc[
-        df.parameter.isin(["kcat", "km", "ki"]), "enzyme"
-    ].apply(lambda x: query_lookup(x, model))
-    df.loc[~pd.isna(df.mic_id), "metabolite"] = df.loc[~pd.isna(df.mic_id), "mic_id"]
-    df.drop("mic_id", axis=1, inplace=True)
+    reac_rows = parameter_rows(groups, INIT_REACTION_PARAMETERS)
+    df["reaction"] = fill_reactions(df, reac_rows, reactions)
+    keep = known_enzyme_rows(parameter_rows(groups, INIT_ENZYME_PARAMETERS), reactions)
+    check_reactions(df, reac_rows, reactions, keep)
+    df = df.iloc[keep]
+    df["metabolite"] = df.pop("mic_id")
     # remove underscores
-    df.enzyme = df.enzyme.str.replace("_", "")
-    df.experiment = df.experiment.str.replace("_", "")
-    df.metabolite = df.metabolite.str.replace("_", "")
+    df.experiment = remove_underscores(df.experiment)
     return df
 
 
@@ -152,6 +283,9 @@ def update_inits(inits_df: pd.DataFrame, model: ModelNew) -> pd.DataFrame:
 @click.argument("output", type=click.Path(dir_okay=False))
 def cli_entry(old_priors: click.Path, new_toml: click.Path, output: click.Path):
     with open(new_toml) as f:
-        model = toml.load(f)
-        model = ModelNew.parse_obj(model)
-    update_priors(pd.read_csv(old_priors), model).to_csv(output, index=False)
+        model = rtoml.load(f, none_value=None)
+    # only the enzyme-reaction pairs are read, skip validating the whole model
+    model = ModelNew.construct(
+        enzyme_reaction=[md.EnzymeReaction(**er) for er in model["enzyme_reaction"]]
+    )
+    write_priors(update_priors(read_priors(old_priors), model), output)